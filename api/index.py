@@ -1,21 +1,41 @@
 import os
+import logging
 import re
+import asyncio
+import hashlib
+import importlib
+import multiprocessing
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response
 from pydantic import BaseModel
-from enum import Enum
-from tree_sitter import Parser
-from tree_sitter_languages import get_language
-import google.generativeai as genai
+import orjson
 from dotenv import load_dotenv
 
 # --- Configuration ---
 load_dotenv()
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+log = logging.getLogger("codecompass.tsvc")
 
 # --- Pydantic Models for API Data Structure ---
+class Edit(BaseModel):
+    start_byte: int
+    old_end_byte: int
+    new_end_byte: int
+    start_point: tuple[int, int]
+    old_end_point: tuple[int, int]
+    new_end_point: tuple[int, int]
+
 class AnalysisRequest(BaseModel):
     language: str
     content: str
+    file_id: str | None = None
+    edits: list[Edit] = []
+    # Hex SHA-256 of the previous content the edits were made against. Required for the file's stored
+    # tree to be reused: edits sent without it, or against another version, are parsed cold.
+    base_hash: str | None = None
 
 class Opportunity(BaseModel):
     type: str
@@ -25,83 +45,339 @@ class Opportunity(BaseModel):
 class AnalysisResponse(BaseModel):
     status: str
     opportunities: list[dict]
+    # Tree-sitter findings, kept apart from the AI's {title, problem, solution} opportunities
+    findings: list[Opportunity] = []
+
+# --- Tree-sitter Queries ---
+# Grammar packages built for the tree-sitter 0.25 ABI, as (module, language function)
+_GRAMMARS = {
+    'python': ('tree_sitter_python', 'language'),
+    'javascript': ('tree_sitter_javascript', 'language'),
+    'typescript': ('tree_sitter_typescript', 'language_typescript'),
+    'tsx': ('tree_sitter_typescript', 'language_tsx'),
+    'go': ('tree_sitter_go', 'language'),
+    'java': ('tree_sitter_java', 'language'),
+}
+_TREE_CACHE_SIZE = 128
+# Tree memory grows with its source, so the cache is also capped by the source bytes it covers (per worker)
+_TREE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+_TREE_BY_ID_SIZE = 10
+_AI_CHUNK_BYTES = 16 * 1024
+_AI_MAX_CONCURRENCY = 8
+_WARM_LANGUAGES = ("python", "javascript", "typescript", "go", "java")
+
+_JS_SECRET_QUERY = """
+(variable_declarator
+  name: (identifier) @variable_name
+  value: [(template_string) @string_value (string) @string_value])
+"""
+
+_QUERY_STRINGS = {
+    'python': """
+(assignment
+  left: (identifier) @variable_name
+  right: (string) @string_value)
+""",
+    'javascript': _JS_SECRET_QUERY,
+    'typescript': _JS_SECRET_QUERY,
+    'tsx': _JS_SECRET_QUERY,
+}
+
+_SENSITIVE_VAR_RE = re.compile(rb'key|secret|token|password|cred', re.IGNORECASE)
+_SENSITIVE_SUBSTRINGS = (b"key", b"secret", b"token", b"password", b"cred")
+
+# Well-known credential formats, matched anywhere in the file regardless of variable names.
+# The flag marks formats whose body must also mix lower case, upper case and digits.
+_TOKEN_PATTERNS = (
+    ("AWS access key", rb"AKIA[0-9A-Z]{16}", False),
+    ("GitHub token", rb"gh[pousr]_[A-Za-z0-9]{36}", False),
+    ("Google API key", rb"AIza[0-9A-Za-z_\-]{35}", False),
+    ("Slack token", rb"xox[baprs]-[0-9A-Za-z\-]{10,}", False),
+    ("Stripe secret key", rb"sk_live_[0-9A-Za-z]{24,}", False),
+    ("OpenAI API key", rb"sk-(?:proj-)?[A-Za-z0-9]{20,}", True),
+)
+# A token can't start in the middle of an identifier or a dashed word
+_TOKEN_BOUNDARY = rb"(?<![A-Za-z0-9_-])"
+# All formats in one alternation, so the source is scanned once; the matching group identifies the format.
+_TOKEN_RE = re.compile(b"|".join(b"(%s%s)" % (_TOKEN_BOUNDARY, pattern) for _, pattern, _ in _TOKEN_PATTERNS))
+
+def _scan_tokens(content_bytes: bytes) -> list[tuple[int, int, int]]:
+    """Returns (pattern index, start, end) for each credential-shaped token in the source."""
+    hits = []
+    for m in _TOKEN_RE.finditer(content_bytes):
+        pattern_id = m.lastindex - 1
+        if not _TOKEN_PATTERNS[pattern_id][2] or _looks_like_secret(m.group()):
+            hits.append((pattern_id, m.start(), m.end()))
+    return hits
+
+def _enclosing_variable(tree, content_bytes: bytes, start: int, end: int) -> str | None:
+    node = tree.root_node.descendant_for_byte_range(start, end)
+    while node is not None:
+        if node.type in ("assignment", "variable_declarator"):
+            name = node.child_by_field_name("left") or node.child_by_field_name("name")
+            if name is not None and name.type == "identifier":
+                return content_bytes[name.start_byte:name.end_byte].decode('utf8')
+            return None
+        node = node.parent
+    return None
+
+def _find_token_secrets(tree, content_bytes: bytes, reported: list[Opportunity]) -> list[Opportunity]:
+    # Needs no tree, so languages tree-sitter can't parse are still scanned; the tree only names the variable.
+    seen = {(opp.line, opp.variable) for opp in reported}
+    found_secrets = []
+    for pattern_id, start, end in _scan_tokens(content_bytes):
+        # Attach the assigned variable when the token sits in an assignment, else name the token kind.
+        variable = None
+        if tree is not None:
+            variable = _enclosing_variable(tree, content_bytes, start, end)
+        variable = variable or _TOKEN_PATTERNS[pattern_id][0]
+        line = content_bytes.count(b"\n", 0, start) + 1
+        if (line, variable) in seen:
+            continue
+        seen.add((line, variable))
+        found_secrets.append(Opportunity(type="HARDCODED_SECRET", line=line, variable=variable))
+    return found_secrets
+
+def _looks_like_secret(raw: bytes) -> bool:
+    # Single left-to-right scan for a run of 20+ alphanumerics mixing lower, upper and digits.
+    run = 0
+    has_lower = has_upper = has_digit = False
+    for b in raw:
+        if 97 <= b <= 122:
+            has_lower = True
+        elif 65 <= b <= 90:
+            has_upper = True
+        elif 48 <= b <= 57:
+            has_digit = True
+        else:
+            run = 0
+            has_lower = has_upper = has_digit = False
+            continue
+        run += 1
+        if run >= 20 and has_lower and has_upper and has_digit:
+            return True
+    return False
+
+def _split_by_toplevel(tree, content_bytes: bytes) -> list[str]:
+    # Packs consecutive top-level nodes into chunks of roughly _AI_CHUNK_BYTES so large files can be
+    # reviewed in parallel; a single oversized node still becomes its own chunk. Files that fit in one
+    # chunk return nothing, meaning the caller sends them whole.
+    if len(content_bytes) <= _AI_CHUNK_BYTES:
+        return []
+    chunks = []
+    start = 0
+    for child in tree.root_node.children:
+        if child.end_byte - start > _AI_CHUNK_BYTES and child.start_byte > start:
+            chunks.append(content_bytes[start:child.start_byte].decode('utf8'))
+            start = child.start_byte
+    chunks.append(content_bytes[start:].decode('utf8'))
+    return chunks
+
+def _strip_code_fences(text: str) -> str:
+    # Fences, if the model adds them anyway, only ever wrap the ends of the response
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else text[3:].removeprefix("json")
+        if text.endswith("```"):
+            text = text[:-3]
+    return text.strip()
 
 # --- Tree-sitter Service ---
+# tree_sitter classes, bound on the first parser load to keep the import off the cold-start path
+Language = Parser = Query = QueryCursor = None
+
+def _load_tree_sitter() -> None:
+    global Language, Parser, Query, QueryCursor
+    if Parser is None:
+        from tree_sitter import Language, Parser, Query, QueryCursor
+
 class TreeSitterService:
     def __init__(self):
         self.parsers = {}
         self.languages = {}
-        print("Tree-sitter Service initialized with on-demand loading.")
+        self._query_cache = {}
+        self._tree_cache = OrderedDict()
+        self._tree_cache_bytes = 0
+        self._tree_by_id = OrderedDict()
+        log.info("Tree-sitter Service initialized with on-demand loading.")
 
-    def _get_parser(self, language_name: str) -> Parser:
-        if language_name in self.parsers:
-            return self.parsers[language_name]
+    def _get_parser(self, language_name: str) -> "Parser":
+        parser = self.parsers.get(language_name)
+        if parser is not None:
+            return parser
+        grammar = _GRAMMARS.get(language_name)
+        if grammar is None:
+            raise HTTPException(status_code=500, detail=f"Parser for language '{language_name}' is not supported.")
         try:
+            _load_tree_sitter()
+            module_name, language_func = grammar
             language = self.languages.get(language_name)
             if not language:
-                language = get_language(language_name)
+                language = Language(getattr(importlib.import_module(module_name), language_func)())
                 self.languages[language_name] = language
-            parser = Parser()
-            parser.set_language(language)
+            parser = Parser(language)
             self.parsers[language_name] = parser
-            print(f"Successfully loaded parser for: {language_name}")
+            log.debug("Successfully loaded parser for: %s", language_name)
             return parser
-        except Exception as e:
-            print(f"Failed to load parser for {language_name}: {e}")
+        except Exception:
+            log.exception("Failed to load parser for %s", language_name)
             raise HTTPException(status_code=500, detail=f"Parser for language '{language_name}' is not supported.")
 
-    def find_opportunities(self, request: AnalysisRequest) -> list[Opportunity]:
-        parser = self._get_parser(request.language)
-        tree = parser.parse(bytes(request.content, "utf8"))
-        
+    def _parse(self, language: str, content_bytes: bytes, content_hash: bytes):
+        # Re-sent files hit an LRU of parsed trees keyed by content hash and skip parsing entirely.
+        key = (language, content_hash)
+        entry = self._tree_cache.get(key)
+        if entry is not None:
+            self._tree_cache.move_to_end(key)
+            return entry[0]
+        tree = self._get_parser(language).parse(content_bytes)
+        size = len(content_bytes)
+        if size > _TREE_CACHE_MAX_BYTES:
+            return tree
+        self._tree_cache[key] = (tree, size)
+        self._tree_cache_bytes += size
+        while len(self._tree_cache) > _TREE_CACHE_SIZE or self._tree_cache_bytes > _TREE_CACHE_MAX_BYTES:
+            _, (_, evicted_size) = self._tree_cache.popitem(last=False)
+            self._tree_cache_bytes -= evicted_size
+        return tree
+
+    def _parse_incremental(
+        self,
+        language: str,
+        content_bytes: bytes,
+        file_id: str,
+        edits: list[Edit] | None,
+        base_hash: str | None,
+        content_hash: bytes,
+    ):
+        # Trees tracked per file are never shared with the hash cache, since editing one mutates it in place.
+        prev = self._tree_by_id.pop(file_id, None)
+        parser = self._get_parser(language)
+        # Reusing a tree for a version other than the edits' base would keep subtrees that no longer
+        # match the text, so anything but an exact base match is parsed cold.
+        if (
+            prev is not None
+            and prev[0] == language
+            and edits
+            and base_hash == prev[1]
+        ):
+            prev_tree = prev[2]
+            for edit in edits:
+                prev_tree.edit(
+                    start_byte=edit.start_byte,
+                    old_end_byte=edit.old_end_byte,
+                    new_end_byte=edit.new_end_byte,
+                    start_point=edit.start_point,
+                    old_end_point=edit.old_end_point,
+                    new_end_point=edit.new_end_point,
+                )
+            tree = parser.parse(content_bytes, prev_tree)
+        else:
+            tree = parser.parse(content_bytes)
+        self._tree_by_id[file_id] = (language, content_hash.hex(), tree)
+        if len(self._tree_by_id) > _TREE_BY_ID_SIZE:
+            self._tree_by_id.popitem(last=False)
+        return tree
+
+    def warm_up(self, languages) -> None:
+        # Loads parsers ahead of time so the first request per language skips it.
+        for language in languages:
+            try:
+                self._get_parser(language)
+            except HTTPException:
+                pass
+
+    def parse(
+        self,
+        language: str,
+        content_bytes: bytes,
+        file_id: str | None = None,
+        edits: list[Edit] | None = None,
+        base_hash: str | None = None,
+        content_hash: bytes | None = None,
+    ):
+        # content_hash is the SHA-256 digest of content_bytes, when the caller already has it
+        if content_hash is None:
+            content_hash = hashlib.sha256(content_bytes).digest()
+        if file_id is not None:
+            return self._parse_incremental(language, content_bytes, file_id, edits, base_hash, content_hash)
+        return self._parse(language, content_bytes, content_hash)
+
+    def find_opportunities(self, tree, language: str, content_bytes: bytes) -> list[Opportunity]:
         opportunities = []
         # We can add more universal finders here later
-        opportunities.extend(self._find_hardcoded_secrets(tree, request.language))
+        opportunities.extend(self._find_hardcoded_secrets(tree, language, content_bytes))
         return opportunities
 
-    def _find_hardcoded_secrets(self, tree, language: str) -> list[Opportunity]:
-        query_string = """
-        (variable_declarator
-          name: (identifier) @variable_name
-          value: [(template_string) @string_value (string) @string_value])
-        """
-        if language == 'python':
-            query_string = """
-            (assignment
-              left: (identifier) @variable_name
-              right: (string) @string_value)
-            """
-        
-        parser = self._get_parser(language)
-        query = parser.language.query(query_string)
-        captures = query.captures(tree.root_node)
+    def _get_query(self, language: str):
+        # Query compilation is expensive, so each language's query is compiled once and reused.
+        query = self._query_cache.get(language)
+        if query is None:
+            query_string = _QUERY_STRINGS.get(language)
+            if query_string is None:
+                return None
+            # Loads the language, and with it the Query class
+            self._get_parser(language)
+            query = self._query_cache.setdefault(language, Query(self.languages[language], query_string))
+        return query
+
+    def _find_hardcoded_secrets(self, tree, language: str, content_bytes: bytes) -> list[Opportunity]:
+        # No sensitive-looking name anywhere in the file means no match is possible, so skip the query.
+        src_lower = content_bytes.lower()
+        if not any(s in src_lower for s in _SENSITIVE_SUBSTRINGS):
+            return []
+
+        # Languages without an assignment query (e.g. go, java) still get the token scan.
+        query = self._get_query(language)
+        if query is None:
+            return []
+
+        # Each match is one assignment, so the variable arrives already paired with its value.
+        matches = QueryCursor(query).matches(tree.root_node)
         
         found_secrets = []
-        SENSITIVE_VAR_REGEX = re.compile(r'key|secret|token|password|cred', re.IGNORECASE)
-        HIGH_ENTROPY_REGEX = re.compile(r'(?=.*[a-z])(?=.*[A-Z])(?=.*[0-9])[a-zA-Z0-9]{20,}')
-
-        variable_nodes = {node.id: node for node, name in captures if name == 'variable_name'}
-        value_nodes = {node.id: node for node, name in captures if name == 'string_value'}
-
-        for node, name in captures:
-            if name == 'variable_name':
-                var_name_text = node.text.decode('utf8')
-                for val_node, val_name in captures:
-                    if val_name == 'string_value' and val_node.parent and val_node.parent.id == node.parent.id:
-                        string_val_text = val_node.text.decode('utf8').strip('\'"`')
-                        if SENSITIVE_VAR_REGEX.search(var_name_text) and HIGH_ENTROPY_REGEX.search(string_val_text):
-                            found_secrets.append(Opportunity(
-                                type="HARDCODED_SECRET",
-                                line=node.start_point[0] + 1,
-                                variable=var_name_text
-                            ))
+        src = memoryview(content_bytes)
+        for _, pair in matches:
+            var_nodes = pair.get('variable_name')
+            val_nodes = pair.get('string_value')
+            if not var_nodes or not val_nodes:
+                continue
+            var_node = var_nodes[0]
+            val_node = val_nodes[0]
+            # Scan straight out of the source buffer; only emitted variable names get decoded.
+            var_name = src[var_node.start_byte:var_node.end_byte]
+            # The name check is far cheaper and more selective than scanning the value, so it goes first.
+            if not _SENSITIVE_VAR_RE.search(var_name):
+                continue
+            if not _looks_like_secret(src[val_node.start_byte + 1:val_node.end_byte - 1]):
+                continue
+            found_secrets.append(Opportunity(
+                type="HARDCODED_SECRET",
+                line=var_node.start_point[0] + 1,
+                variable=bytes(var_name).decode('utf8')
+            ))
         return found_secrets
 
 # --- AI Service ---
 class AIService:
     def __init__(self):
+        # Imported here rather than at module top: gRPC and protobuf dominate cold-start import time.
+        import google.generativeai as genai
+        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+        # One model for the whole process: it lazily creates a single async gRPC client whose
+        # HTTP/2 channel multiplexes concurrent requests, so connections are reused across calls.
         self.model = genai.GenerativeModel('gemini-1.5-flash')
-        print("AI Service initialized.")
+        # One cap on in-flight Gemini calls across every request, created on the loop that first uses it
+        self._semaphore = None
+        self._semaphore_loop = None
+        log.info("AI Service initialized.")
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(_AI_MAX_CONCURRENCY)
+            self._semaphore_loop = loop
+        return self._semaphore
 
     def create_universal_prompt(self, language: str, code_snippet: str) -> str:
         # This is the universal, language-agnostic prompt
@@ -130,16 +406,24 @@ class AIService:
         ```
         """
 
-    async def generate_insights(self, request: AnalysisRequest) -> list[dict]:
-        prompt = self.create_universal_prompt(request.language, request.content)
+    async def generate_insights(self, request: AnalysisRequest, chunks: list[str] | None = None) -> list[dict]:
+        chunks = chunks or [request.content]
+        semaphore = self._get_semaphore()
+        results = await asyncio.gather(
+            *(self._generate_chunk_insights(request.language, chunk, semaphore) for chunk in chunks)
+        )
+        return [opportunity for result in results for opportunity in result]
+
+    async def _generate_chunk_insights(self, language: str, code_snippet: str, semaphore: asyncio.Semaphore) -> list[dict]:
+        prompt = self.create_universal_prompt(language, code_snippet)
         try:
-            response = await self.model.generate_content_async(prompt)
-            # A more robust JSON parsing
-            cleaned_response = re.sub(r'```json\s*|\s*```', '', response.text.strip())
-            data = json.loads(cleaned_response)
+            async with semaphore:
+                response = await self.model.generate_content_async(prompt)
+            cleaned_response = _strip_code_fences(response.text)
+            data = orjson.loads(cleaned_response)
             return data.get("opportunities", [])
         except Exception as e:
-            print(f"AI insight generation failed: {e}")
+            log.warning("AI insight generation failed: %s", e)
             return []
 
 
@@ -151,11 +435,131 @@ app = FastAPI(
 )
 
 tree_sitter_service = TreeSitterService()
-ai_service = AIService()
+ai_service = None
+# One single-worker pool per shard, so a file always reaches the worker holding its trees
+process_pools: list[ProcessPoolExecutor] = []
+inline_executor = None
+
+def get_ai_service() -> AIService:
+    # Built on first use so the Gemini SDK is only loaded once an analysis actually needs it.
+    global ai_service
+    if ai_service is None:
+        ai_service = AIService()
+    return ai_service
+
+# --- Tree-sitter Worker Pool ---
+def _init_worker():
+    # Each worker process owns its own service, parsers and caches.
+    global tree_sitter_service
+    tree_sitter_service = TreeSitterService()
+    tree_sitter_service.warm_up(_WARM_LANGUAGES)
+
+def _analyze_sync(
+    language: str,
+    content_bytes: bytes,
+    file_id: str | None,
+    edits: list[Edit],
+    base_hash: str | None,
+    content_hash: bytes | None = None,
+) -> tuple[list[dict], list[str]]:
+    """Returns the tree-sitter findings and the code chunks to send to the AI service.
+
+    Takes the encoded source rather than the request so the content crosses the process boundary once.
+    No chunks means the file is sent to the AI service whole.
+    """
+    tree = None
+    opportunities = []
+    chunks = []
+    try:
+        tree = tree_sitter_service.parse(language, content_bytes, file_id, edits, base_hash, content_hash)
+        opportunities = tree_sitter_service.find_opportunities(tree, language, content_bytes)
+        chunks = _split_by_toplevel(tree, content_bytes)
+    except Exception as e:
+        # Languages tree-sitter can't handle are still reviewed by the AI service, unsplit.
+        log.warning("Tree-sitter analysis failed: %s", e)
+    opportunities.extend(_find_token_secrets(tree, content_bytes, opportunities))
+    return [opp.model_dump() for opp in opportunities], chunks
+
+def _pool_context():
+    # Forking a process that has loaded gRPC is unsafe, so workers start from a clean interpreter.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+def _new_shard() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=1, mp_context=_pool_context(), initializer=_init_worker)
+
+@app.on_event("startup")
+def start_process_pool():
+    global process_pools
+    pools = []
+    try:
+        for _ in range(os.cpu_count() or 1):
+            pools.append(_new_shard())
+        # Workers start on their pool's first submit, so waiting here means every shard is running and
+        # warm before the first request.
+        wait([pool.submit(os.getpid) for pool in pools])
+        process_pools = pools
+    except (OSError, NotImplementedError) as e:
+        # Some serverless runtimes lack the semaphores multiprocessing needs; analyze in-process instead.
+        log.warning("Process pool unavailable, running tree-sitter in-process: %s", e)
+        for pool in pools:
+            pool.shutdown(cancel_futures=True)
+        tree_sitter_service.warm_up(_WARM_LANGUAGES)
+
+@app.on_event("shutdown")
+def stop_process_pool():
+    global process_pools, inline_executor
+    for pool in process_pools:
+        pool.shutdown(cancel_futures=True)
+    process_pools = []
+    if inline_executor is not None:
+        inline_executor.shutdown(cancel_futures=True)
+        inline_executor = None
+
+def _replace_shard(shard: int, broken: ProcessPoolExecutor) -> None:
+    # Concurrent requests on the broken shard all land here; only the first replaces it.
+    if process_pools[shard] is broken:
+        process_pools[shard] = _new_shard()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+def get_inline_executor() -> ThreadPoolExecutor:
+    # Without a pool, analysis still runs off the event loop. A single thread, since the in-process
+    # service and its caches aren't thread-safe.
+    global inline_executor
+    if inline_executor is None:
+        inline_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tree-sitter")
+    return inline_executor
+
+async def run_tree_sitter(
+    request: AnalysisRequest, content_bytes: bytes, content_hash: bytes
+) -> tuple[list[dict], list[str]]:
+    args = (request.language, content_bytes, request.file_id, request.edits, request.base_hash, content_hash)
+    loop = asyncio.get_running_loop()
+    if not process_pools:
+        return await loop.run_in_executor(get_inline_executor(), _analyze_sync, *args)
+    # Pins each file to one shard: edits reach the worker holding the file's previous tree, and
+    # re-sent content reaches the worker whose cache holds its parse.
+    key = request.file_id.encode('utf-8') if request.file_id is not None else content_hash
+    shard = zlib.crc32(key) % len(process_pools)
+    for _ in range(2):
+        pool = process_pools[shard]
+        try:
+            return await loop.run_in_executor(pool, _analyze_sync, *args)
+        except BrokenProcessPool:
+            # A dead worker breaks its pool for good, so the shard gets a fresh one and the job one retry.
+            log.warning("Tree-sitter worker died, restarting shard %d", shard)
+            _replace_shard(shard, pool)
+    # Crashed twice: don't risk a third worker on the same input.
+    return [], []
+
+# Serialized once: the root doubles as the load balancer's health check.
+_ROOT_BODY = b'{"status":"ok","message":"CodeCompass Analysis Engine is running."}'
 
 @app.get("/")
 def read_root():
-    return {"status": "ok", "message": "CodeCompass Analysis Engine is running."}
+    # A fresh Response per request, since FastAPI attaches per-request state to the one returned
+    return Response(content=_ROOT_BODY, media_type="application/json")
 
 @app.post("/analyze-file", response_model=AnalysisResponse)
 async def analyze_file(request: AnalysisRequest):
@@ -163,11 +567,18 @@ async def analyze_file(request: AnalysisRequest):
     Accepts a code file and language, analyzes it with tree-sitter and AI,
     and returns the findings.
     """
-    # For now, we are going straight to the AI.
-    # In the future, we can combine tree-sitter findings with AI findings.
-    ai_opportunities = await ai_service.generate_insights(request)
+    # Encoded and hashed once; the digest routes the request and keys the worker's tree cache.
+    content_bytes = request.content.encode('utf-8')
+    content_hash = hashlib.sha256(content_bytes).digest()
+    if len(content_bytes) > _AI_CHUNK_BYTES:
+        # Large files wait for tree-sitter so they can be sharded into concurrent AI requests.
+        tree_sitter_opps, chunks = await run_tree_sitter(request, content_bytes, content_hash)
+        ai_opportunities = await get_ai_service().generate_insights(request, chunks)
+    else:
+        # Small files are sent whole, so tree-sitter runs off the event loop while the AI request is in flight.
+        (tree_sitter_opps, _), ai_opportunities = await asyncio.gather(
+            run_tree_sitter(request, content_bytes, content_hash),
+            get_ai_service().generate_insights(request),
+        )
     
-    return AnalysisResponse(status="analyzed", opportunities=ai_opportunities)
-
-# Need to import json for the AI service
-import json
+    return AnalysisResponse(status="analyzed", opportunities=ai_opportunities, findings=tree_sitter_opps)